@@ -10,6 +10,7 @@ NIFTY LONG STRADDLE – SPOT (LIVE SAFE, STOCKO + KILL-SWITCH + ATM ROLLING)
     - If FALSE while position OPEN -> immediate square-off + halt
     - Resume when TRUE again (and no positions)
 ✔ PAPER + LIVE safe
+✔ LTPs streamed over KiteTicker (REST kite.ltp() only when a tick is missing/stale)
 ✔ NO fake PnL (pos created only if Stocko succeeds)
 
 🆕 FIXED / ADDED (as requested)
@@ -25,20 +26,27 @@ NIFTY LONG STRADDLE – SPOT (LIVE SAFE, STOCKO + KILL-SWITCH + ATM ROLLING)
    - FLAG_FALSE_SQUAREOFF
 """
 
-import os, time, pytz, requests
-from datetime import datetime, time as dt_time
-import pandas as pd
+import csv, io, os, sys, time, queue, random, requests, signal, threading, traceback
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta, time as dt_time
+from zoneinfo import ZoneInfo
 import psycopg2
-from psycopg2.extras import RealDictCursor
+from psycopg2.extensions import connection as PgConnection
+from psycopg2.pool import ThreadedConnectionPool
 from psycopg2 import sql
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from kiteconnect import KiteConnect
+from kiteconnect.exceptions import NetworkException
 
 # =========================================================
 # CONFIG
 # =========================================================
 
 BOT_NAME = "LS_NIFTY_SPOT"
-MARKET_TZ = pytz.timezone("Asia/Kolkata")
+MARKET_TZ = ZoneInfo("Asia/Kolkata")
 
 MARKET_OPEN  = dt_time(9, 15)
 MARKET_CLOSE = dt_time(15, 30)
@@ -48,42 +56,105 @@ SQUARE_OFF   = dt_time(15, 25)
 STRIKE_STEP = int(os.getenv("STRIKE_STEP", 50))
 ENTRY_TOL   = int(os.getenv("ENTRY_TOL", 25))
 QTY         = int(os.getenv("QTY_PER_LEG", 65))
+_HALF_STEP  = STRIKE_STEP / 2    # float: an odd STRIKE_STEP must not lose its .5
 
-SNAPSHOT_SEC = 60
 POLL_SEC = 1
+MAX_RETRY_SEC = 10          # cap on the loop's error backoff
+SNAPSHOT_FLUSH_EVERY = int(os.getenv("SNAPSHOT_FLUSH_EVERY", 30))
+SNAPSHOT_FLUSH_SEC = int(os.getenv("SNAPSHOT_FLUSH_SEC", 300))   # max age of a buffered row
+LOG_COPY_MIN_ROWS = int(os.getenv("LOG_COPY_MIN_ROWS", 50))
+SNAPSHOT_HEARTBEAT_SEC = 60 * int(os.getenv("SNAPSHOT_HEARTBEAT_MIN", 5))
 
 LIVE_MODE = os.getenv("LIVE_MODE", "false").strip().lower() in ("1", "true", "yes")
 
 TABLE_NAME = "nifty_long_strang_roll"
+# UNLOGGED skips WAL for every row, but Postgres empties the table after a crash.
+# Only turn on if the log is treated as best-effort.
+LOG_TABLE_UNLOGGED = os.getenv("LOG_TABLE_UNLOGGED", "false").strip().lower() in ("1", "true", "yes")
+DB_CONNECT_TIMEOUT = 5      # seconds; libpq otherwise waits on a dead host indefinitely
 FLAG_TABLE = "trade_flag"
 FLAG_COL   = "live_ls_nifty_spot"
 
 SPOT_INSTRUMENT = "NSE:NIFTY 50"
+SPOT_TOKEN = 256265         # instrument_token of NSE:NIFTY 50
 
 KITE_API_KEY = os.getenv("KITE_API_KEY", "").strip()
 KITE_ACCESS_TOKEN = os.getenv("KITE_ACCESS_TOKEN", "").strip()
+KITE_TIMEOUT = (1.0, 2.0)   # (connect, read) seconds; kiteconnect default is a flat 7s
+USE_TICKER = os.getenv("USE_TICKER", "true").strip().lower() in ("1", "true", "yes")
+TICK_STALE_SEC = float(os.getenv("TICK_STALE_SEC", 5))   # older ticks fall back to REST
+TICK_IDLE_SEC = 120         # unsubscribe tokens ltp() has not asked for in this long
 
 STOCKO_BASE_URL = os.getenv("STOCKO_BASE_URL", "https://api.stocko.in").strip()
 STOCKO_ACCESS_TOKEN = os.getenv("STOCKO_ACCESS_TOKEN", "").strip()
 STOCKO_CLIENT_ID = os.getenv("STOCKO_CLIENT_ID", "").strip()
+STOCKO_TIMEOUT = (2, 8)     # (connect, read) seconds
 
 # =========================================================
 # DB
 # =========================================================
 
+class LogConnection(PgConnection):
+    """
+    psycopg2 connection in autocommit mode (each statement is its own implicit
+    transaction, no extra COMMIT round trip) that remembers whether the log
+    INSERT is PREPAREd on it.
+    """
+    log_prepared = False
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.autocommit = True
+
+_POOL = None
+
+def db_pool():
+    """
+    Process-wide connection pool so the loop does not pay a TLS handshake per query.
+    """
+    global _POOL
+    if _POOL is None:
+        url = os.getenv("DATABASE_URL")
+        if not url:
+            raise RuntimeError("DATABASE_URL env var not found")
+        _POOL = ThreadedConnectionPool(
+            1, 4, url,
+            sslmode="require",
+            connect_timeout=DB_CONNECT_TIMEOUT,
+            connection_factory=LogConnection,
+        )
+    return _POOL
+
 def db_conn():
-    url = os.getenv("DATABASE_URL")
-    if not url:
-        raise RuntimeError("DATABASE_URL env var not found")
-    return psycopg2.connect(url, sslmode="require", cursor_factory=RealDictCursor)
+    return db_pool().getconn()
+
+def release_conn(conn, close=False):
+    db_pool().putconn(conn, close=close)
 
-def ensure_schema(conn):
+@contextmanager
+def pooled_conn():
+    """
+    Borrow a pooled connection; a connection that raised is discarded, not reused.
+    """
+    conn = db_conn()
+    try:
+        yield conn
+    except Exception:
+        release_conn(conn, close=True)
+        raise
+    release_conn(conn)
+
+def ensure_schema():
     """
     Creates table if missing, and adds required columns if table already exists.
+    All DDL goes out as one batch (one round trip, one implicit transaction)
+    under an advisory lock, so two bots starting together do not race on it.
     """
-    with conn.cursor() as c:
-        c.execute(sql.SQL("""
-        CREATE TABLE IF NOT EXISTS {t} (
+    t = sql.Identifier(TABLE_NAME)
+    stmts = [
+        sql.SQL("SELECT pg_advisory_xact_lock(hashtext({n}))").format(n=sql.Literal(TABLE_NAME)),
+        sql.SQL("""
+        CREATE {unlogged} TABLE IF NOT EXISTS {t} (
             id SERIAL PRIMARY KEY,
             ts TIMESTAMPTZ,
             bot_name TEXT,
@@ -98,9 +169,12 @@ def ensure_schema(conn):
             pe_entry NUMERIC,
             ce_exit NUMERIC,
             pe_exit NUMERIC
-        );
-        """).format(t=sql.Identifier(TABLE_NAME)))
-    conn.commit()
+        )
+        """).format(t=t, unlogged=sql.SQL("UNLOGGED" if LOG_TABLE_UNLOGGED else "")),
+    ]
+    if LOG_TABLE_UNLOGGED:
+        # no-op when already unlogged; converts a table created before the flag
+        stmts.append(sql.SQL("ALTER TABLE {t} SET UNLOGGED").format(t=t))
 
     # light auto-migration (safe if columns already exist)
     cols = [
@@ -110,84 +184,353 @@ def ensure_schema(conn):
         ("ce_exit", "NUMERIC"),
         ("pe_exit", "NUMERIC"),
     ]
-    with conn.cursor() as c:
-        for col, typ in cols:
-            c.execute(sql.SQL("ALTER TABLE {t} ADD COLUMN IF NOT EXISTS {c} " + typ).format(
-                t=sql.Identifier(TABLE_NAME),
-                c=sql.Identifier(col)
+    # one ALTER for all columns: a single catalog lock instead of one per column
+    stmts.append(sql.SQL("ALTER TABLE {t} ").format(t=t) + sql.SQL(", ").join(
+        sql.SQL("ADD COLUMN IF NOT EXISTS {c} " + typ).format(c=sql.Identifier(col))
+        for col, typ in cols
+    ))
+
+    with pooled_conn() as conn:
+        with conn.cursor() as c:
+            c.execute(sql.SQL("; ").join(stmts))
+
+LOG_COLS = ("ts", "bot_name", "event", "reason", "spot", "atm", "ce_symbol", "pe_symbol",
+            "unreal_pnl", "ce_entry", "pe_entry", "ce_exit", "pe_exit")
+
+# log_db() only enqueues; a single writer thread owns the DB writes
+LOG_Q = queue.Queue(maxsize=1000)
+_FLUSH = object()                      # sentinel: write whatever is buffered now
+# caller waits until these (and every row queued before them) are handed to the
+# writer. ROLL_ENTRY rather than ROLL_EXIT, so a roll never waits on Postgres
+# between selling the old legs and buying the new ones.
+DURABLE_EVENTS = ("EXIT", "ROLL_ENTRY")
+
+# rows waiting for the next batched INSERT (oldest first); writer thread only
+SNAPSHOT_BUFFER = []
+_LOG_WRITER = None
+
+def _prepare_log_insert(conn, c):
+    """
+    PREPAREs the log INSERT once per session so each row skips parse/plan.
+    """
+    if conn.log_prepared:
+        return
+    c.execute(sql.SQL("PREPARE log_ins AS INSERT INTO {t} ({cols}) VALUES ({params})").format(
+        t=sql.Identifier(TABLE_NAME),
+        cols=sql.SQL(", ").join(map(sql.Identifier, LOG_COLS)),
+        params=sql.SQL(", ".join(f"${i}" for i in range(1, len(LOG_COLS) + 1)))
+    ))
+    conn.log_prepared = True
+
+def _copy_rows(c, rows):
+    """
+    COPY ... FROM STDIN (csv); None is written as an unquoted empty field, i.e. NULL.
+    """
+    buf = io.StringIO()
+    csv.writer(buf).writerows(rows)
+    buf.seek(0)
+    c.copy_expert(sql.SQL("COPY {t} ({cols}) FROM STDIN WITH (FORMAT csv)").format(
+        t=sql.Identifier(TABLE_NAME),
+        cols=sql.SQL(", ").join(map(sql.Identifier, LOG_COLS))
+    ), buf)
+
+_EXECUTE_LOG_INS = "EXECUTE log_ins (" + ", ".join(["%s"] * len(LOG_COLS)) + ")"
+
+def _write_buffer():
+    """
+    Writes all buffered rows in one round trip: COPY for large backlogs,
+    otherwise one explicit transaction of prepared EXECUTEs. A batch holding
+    only SNAPSHOTs commits with synchronous_commit off (no wait on WAL fsync);
+    a batch carrying ENTRY/EXIT/... rows keeps the durable commit.
+    """
+    if not SNAPSHOT_BUFFER:
+        return
+    with pooled_conn() as conn:
+        with conn.cursor() as c:
+            if len(SNAPSHOT_BUFFER) >= LOG_COPY_MIN_ROWS:
+                _copy_rows(c, SNAPSHOT_BUFFER)
+            else:
+                _prepare_log_insert(conn, c)
+                body = b"; ".join(c.mogrify(_EXECUTE_LOG_INS, r) for r in SNAPSHOT_BUFFER)
+                if all(r[2] == "SNAPSHOT" for r in SNAPSHOT_BUFFER):
+                    body = b"SET LOCAL synchronous_commit TO OFF; " + body
+                c.execute(b"BEGIN; " + body + b"; COMMIT")
+    SNAPSHOT_BUFFER.clear()
+
+def _log_writer():
+    """
+    SNAPSHOT rows are buffered and written every SNAPSHOT_FLUSH_EVERY rows, or
+    once the oldest has waited SNAPSHOT_FLUSH_SEC. Any other event (ENTRY /
+    EXIT / ROLL / ERROR ...) is written as soon as it arrives, draining the
+    buffer with it so rows land in order. A failed write keeps the rows
+    buffered and is retried SNAPSHOT_FLUSH_SEC later (or on the next event).
+    """
+    deadline = None     # monotonic time by which the buffered rows get written
+    while True:
+        timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+        try:
+            row = LOG_Q.get(timeout=timeout)
+            queued = True
+        except queue.Empty:
+            row, queued = _FLUSH, False
+        try:
+            if row is not _FLUSH:
+                SNAPSHOT_BUFFER.append(row)
+            if row is _FLUSH or row[2] != "SNAPSHOT" or len(SNAPSHOT_BUFFER) >= SNAPSHOT_FLUSH_EVERY:
+                _write_buffer()
+        except Exception as e:
+            print("❌ DB LOG FAILED:", e)
+            deadline = None
+        finally:
+            if queued:
+                LOG_Q.task_done()
+        if not SNAPSHOT_BUFFER:
+            deadline = None
+        elif deadline is None:
+            deadline = time.monotonic() + SNAPSHOT_FLUSH_SEC
+
+def _ensure_log_writer():
+    global _LOG_WRITER
+    if _LOG_WRITER is None:
+        _LOG_WRITER = threading.Thread(target=_log_writer, name="log-writer", daemon=True)
+        _LOG_WRITER.start()
+
+def flush_snapshots():
+    """
+    Blocks until every queued / buffered row has been handed to the writer and
+    a write attempted (a failed write is not retried here).
+    """
+    if _LOG_WRITER is None:
+        return
+    LOG_Q.put(_FLUSH)
+    LOG_Q.join()
+
+def log_db(*, bot, event, reason, spot, atm, ce_sym, pe_sym, unreal,
+           ce_entry, pe_entry, ce_exit, pe_exit):
+    """
+    Queues a row for the writer thread so the trading loop never waits on Postgres,
+    except for DURABLE_EVENTS, which block until the writer has taken the row and
+    attempted the write. A failed write stays buffered for a later retry, so this
+    is "handed to the writer", not a guarantee the row is in the table.
+    Parameters mirror LOG_COLS (minus ts) and bind straight into the row tuple.
+    """
+    _ensure_log_writer()
+    row = (
+        datetime.now(MARKET_TZ), bot, event, reason, spot, atm,
+        ce_sym, pe_sym, unreal, ce_entry, pe_entry, ce_exit, pe_exit,
+    )
+    if event == "SNAPSHOT":
+        try:
+            LOG_Q.put_nowait(row)
+        except queue.Full:
+            print("⚠️ LOG QUEUE FULL, SNAPSHOT DROPPED")
+        return
+    LOG_Q.put(row)
+    if event in DURABLE_EVENTS:
+        LOG_Q.join()
+
+def trade_allowed():
+    with pooled_conn() as conn:
+        with conn.cursor() as c:
+            c.execute(sql.SQL("SELECT {c} FROM {t} LIMIT 1").format(
+                c=sql.Identifier(FLAG_COL),
+                t=sql.Identifier(FLAG_TABLE)
             ))
-    conn.commit()
-
-def log_db(conn, **k):
-    with conn.cursor() as c:
-        c.execute(sql.SQL("""
-        INSERT INTO {t}
-        (ts, bot_name, event, reason, spot, atm, ce_symbol, pe_symbol, unreal_pnl, ce_entry, pe_entry, ce_exit, pe_exit)
-        VALUES
-        (NOW(), %(bot)s, %(event)s, %(reason)s, %(spot)s, %(atm)s, %(ce_sym)s, %(pe_sym)s,
-         %(unreal)s, %(ce_entry)s, %(pe_entry)s, %(ce_exit)s, %(pe_exit)s)
-        """).format(t=sql.Identifier(TABLE_NAME)), k)
-    conn.commit()
-
-def trade_allowed(conn):
-    with conn.cursor() as c:
-        c.execute(sql.SQL("SELECT {c} FROM {t} LIMIT 1").format(
-            c=sql.Identifier(FLAG_COL),
-            t=sql.Identifier(FLAG_TABLE)
-        ))
-        r = c.fetchone()
-        return bool(r[FLAG_COL]) if r else False
+            r = c.fetchone()
+    return bool(r[0]) if r else False
 
 # =========================================================
 # KITE
 # =========================================================
 
-kite = KiteConnect(api_key=KITE_API_KEY)
+# pooled keep-alive adapter on kite.reqsession; the client is never rebuilt on timeouts
+kite = KiteConnect(
+    api_key=KITE_API_KEY,
+    timeout=KITE_TIMEOUT,
+    pool={"pool_connections": 4, "pool_maxsize": 8},
+)
 kite.set_access_token(KITE_ACCESS_TOKEN)
 
+if USE_TICKER:
+    # stream-only imports; with USE_TICKER=false prices come from REST ltp() alone
+    from kiteconnect import KiteTicker
+    from twisted.internet import reactor
+
+# "EXCH:tradingsymbol" -> instrument_token; option tokens are added by build_option_index()
+INST_TOKENS = {SPOT_INSTRUMENT: SPOT_TOKEN}
+
+_TICKS = {}     # token -> (last_price, monotonic time of the tick); written by the ticker thread
+_WANTED = {}    # token -> monotonic time ltp() last asked for it
+_ticker = None
+
+def _on_ticks(ws, ticks):
+    now = time.monotonic()
+    for t in ticks:
+        _TICKS[t["instrument_token"]] = (t["last_price"], now)
+
+def _on_connect(ws, response):
+    # also runs on every reconnect: put back whatever the loop is watching
+    tokens = list(_WANTED)
+    if tokens:
+        ws.subscribe(tokens)
+        ws.set_mode(ws.MODE_LTP, tokens)
+
+def _on_close(ws, code, reason):
+    print("⚠️ TICKER CLOSED:", code, reason)
+
+def _on_error(ws, code, reason):
+    print("⚠️ TICKER ERROR:", code, reason)
+
+def start_ticker():
+    """
+    Background KiteTicker (own reactor thread, auto-reconnect). ltp() keeps
+    working off REST if it never connects.
+    """
+    global _ticker
+    if not USE_TICKER or _ticker is not None:
+        return
+    _ticker = KiteTicker(KITE_API_KEY, KITE_ACCESS_TOKEN)
+    _ticker.on_ticks = _on_ticks
+    _ticker.on_connect = _on_connect
+    _ticker.on_close = _on_close
+    _ticker.on_error = _on_error
+    _ticker.connect(threaded=True)
+
+def _subscribe_ltp(tokens):
+    _ticker.subscribe(tokens)
+    _ticker.set_mode(_ticker.MODE_LTP, tokens)
+
+def _ticker_call(fn, tokens):
+    # subscribe/unsubscribe write to the socket, which belongs to the reactor thread
+    if _ticker is not None and _ticker.is_connected():
+        reactor.callFromThread(fn, tokens)
+
+def _watch(tokens, now):
+    """
+    Keep the ticker subscribed to exactly what the loop asks for: new tokens
+    are subscribed on first request (legs on entry/roll), tokens nobody asked
+    for in TICK_IDLE_SEC are dropped (legs after exit/roll).
+    """
+    new = [t for t in tokens if t not in _WANTED]
+    for t in tokens:
+        _WANTED[t] = now
+    if new:
+        _ticker_call(_subscribe_ltp, new)
+    idle = [t for t, seen in _WANTED.items() if now - seen > TICK_IDLE_SEC]
+    if idle:
+        for t in idle:
+            del _WANTED[t]
+            _TICKS.pop(t, None)
+        _ticker_call(_ticker.unsubscribe, idle)
+
 def ltp(insts):
-    q = kite.ltp(insts)
-    return {k: v["last_price"] for k, v in q.items()}
+    """
+    {inst: last_price}. Fresh ticker prices are used as-is; anything without a
+    tick in the last TICK_STALE_SEC goes out in one REST kite.ltp() call.
+    """
+    now = time.monotonic()
+    out, missing, tokens = {}, [], []
+    for inst in insts:
+        tok = INST_TOKENS.get(inst)
+        tick = _TICKS.get(tok) if tok is not None else None
+        if tok is not None:
+            tokens.append(tok)
+        if tick is not None and now - tick[1] <= TICK_STALE_SEC:
+            out[inst] = tick[0]
+        else:
+            missing.append(inst)
+    if USE_TICKER and tokens:
+        _watch(tokens, now)
+    if missing:
+        q = kite.ltp(missing)
+        out.update({k: v["last_price"] for k, v in q.items()})
+    return out
 
 # =========================================================
 # STOCKO
 # =========================================================
 
-def _stocko_headers():
-    return {"Authorization": f"Bearer {STOCKO_ACCESS_TOKEN}"}
-
-def stocko_place_by_tradingsymbol(tradingsymbol: str, side: str, qty: int, offset=0):
+# keep-alive session so orders do not pay a fresh TCP+TLS handshake each.
+# Retry re-sends only idempotent requests (search GET) on read errors / 502-504.
+# connect=0 and other=0 because urllib3 retries those for every method, POST
+# included, and a re-sent order POST can place the order twice.
+STOCKO_SESSION = requests.Session()
+STOCKO_SESSION.mount("https://", HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=8,
+    max_retries=Retry(total=2, connect=0, other=0, backoff_factor=0.2,
+                      status_forcelist=[502, 503, 504], raise_on_status=False),
+))
+STOCKO_SESSION.headers.update({"Authorization": f"Bearer {STOCKO_ACCESS_TOKEN}"})
+
+# tradingsymbol -> Stocko NFO token (fixed for the life of a contract)
+_STOCKO_TOKEN_CACHE = {}
+
+def stocko_search_token(tradingsymbol: str) -> int:
     """
-    MARKET order. In PAPER mode returns simulated success.
+    Resolves the Stocko NFO instrument token, hitting /search only once per symbol.
     """
-    if not LIVE_MODE:
-        return {"simulated": True}
-
-    if not STOCKO_ACCESS_TOKEN or not STOCKO_CLIENT_ID:
-        raise RuntimeError("LIVE_MODE=True but STOCKO creds missing.")
+    token = _STOCKO_TOKEN_CACHE.get(tradingsymbol)
+    if token is not None:
+        return token
 
-    r = requests.get(
+    r = STOCKO_SESSION.get(
         f"{STOCKO_BASE_URL}/api/v1/search",
         params={"key": tradingsymbol},
-        headers=_stocko_headers(),
-        timeout=10
+        timeout=STOCKO_TIMEOUT
     )
     r.raise_for_status()
     data = r.json()
     result = data.get("result") or data.get("data", {}).get("result", [])
 
-    token = None
     for rec in result:
-        if rec.get("exchange") == "NFO":
-            token = rec.get("token")
+        if rec.get("exchange") == "NFO" and rec.get("token") is not None:
+            token = int(rec["token"])
             break
     if token is None:
         raise RuntimeError(f"Stocko token not found for {tradingsymbol}")
 
+    _STOCKO_TOKEN_CACHE[tradingsymbol] = token
+    return token
+
+def stocko_prewarm_tokens(symbols):
+    """
+    Resolves Stocko tokens on a background thread so later orders for these
+    symbols skip the /search round trip. Failures only cost that later lookup.
+    """
+    todo = [s for s in symbols if s and s not in _STOCKO_TOKEN_CACHE]
+    if not LIVE_MODE or not todo:
+        return
+
+    def run():
+        for s in todo:
+            try:
+                stocko_search_token(s)
+            except Exception as e:
+                print("⚠️ STOCKO PREWARM FAILED:", s, e)
+
+    threading.Thread(target=run, name="stocko-prewarm", daemon=True).start()
+
+def stocko_place_by_tradingsymbol(tradingsymbol: str, side: str, qty: int, offset=0, base_ms=None):
+    """
+    MARKET order. In PAPER mode returns simulated success.
+    user_order_id is base_ms + offset; orders sent together must share base_ms
+    so their distinct offsets keep the ids distinct.
+    """
+    if not LIVE_MODE:
+        return {"simulated": True}
+
+    if not STOCKO_ACCESS_TOKEN or not STOCKO_CLIENT_ID:
+        raise RuntimeError("LIVE_MODE=True but STOCKO creds missing.")
+
+    token = stocko_search_token(tradingsymbol)
+    if base_ms is None:
+        base_ms = int(time.time() * 1000)
+
     payload = {
         "exchange": "NFO",
         "order_type": "MARKET",
-        "instrument_token": int(token),
+        "instrument_token": token,
         "quantity": int(qty),
         "disclosed_quantity": 0,
         "order_side": side.upper(),
@@ -196,16 +539,15 @@ def stocko_place_by_tradingsymbol(tradingsymbol: str, side: str, qty: int, offse
         "validity": "DAY",
         "product": "MIS",
         "client_id": STOCKO_CLIENT_ID,
-        "user_order_id": str(int(time.time() * 1000) + offset)[-15:],
+        "user_order_id": str(base_ms + offset)[-15:],
         "market_protection_percentage": 0,
         "device": "WEB"
     }
 
-    r = requests.post(
+    r = STOCKO_SESSION.post(
         f"{STOCKO_BASE_URL}/api/v1/orders",
         json=payload,
-        headers=_stocko_headers(),
-        timeout=10
+        timeout=STOCKO_TIMEOUT
     )
     print("🧾 STOCKO", side.upper(), tradingsymbol, r.status_code, r.text)
     if r.status_code != 200:
@@ -213,375 +555,560 @@ def stocko_place_by_tradingsymbol(tradingsymbol: str, side: str, qty: int, offse
 
     return r.json()
 
+# one worker per leg: the two orders of a pair wait on the network side by side
+_ORDER_POOL = ThreadPoolExecutor(max_workers=2, thread_name_prefix="stocko")
+
+def stocko_place_pair(ce_ts: str, pe_ts: str, side: str, qty: int, ce_offset: int, pe_offset: int):
+    """
+    Sends the CE and PE orders concurrently (one round trip instead of two) and
+    returns (ce_err, pe_err): None for a leg Stocko accepted, the exception for
+    one that failed. Never raises, so the caller always knows which leg went
+    through and can track a one-sided fill instead of resending the pair.
+    A leg passed as None (already closed) is not sent and reports None.
+    """
+    base_ms = int(time.time() * 1000)   # one clock read: the worker threads would each see a different ms
+    futs = [
+        _ORDER_POOL.submit(stocko_place_by_tradingsymbol, ts, side, qty, offset, base_ms) if ts else None
+        for ts, offset in ((ce_ts, ce_offset), (pe_ts, pe_offset))
+    ]
+    wait([f for f in futs if f is not None])
+    return tuple(f.exception() if f is not None else None for f in futs)
+
 # =========================================================
 # OPTION PICKER
 # =========================================================
 
-def pick_atm_symbols(nfo_df: pd.DataFrame, atm: int):
+def round_to_strike(price: float) -> int:
+    """
+    Nearest strike, ties rounded up (spot is always positive, so int() == floor).
+    """
+    return int(price + _HALF_STEP) // STRIKE_STEP * STRIKE_STEP
+
+def _expiry_date(inst):
+    e = inst.get("expiry")
+    if isinstance(e, datetime):
+        return e.date()
+    if isinstance(e, date):
+        return e
+    try:
+        return datetime.strptime(str(e), "%Y-%m-%d").date()
+    except ValueError:
+        return None
+
+def build_option_index(instruments):
     """
-    Picks nearest expiry CE/PE for a given strike from NFO instruments snapshot.
+    One pass over the NFO instruments dump:
+    {(strike, "CE"/"PE"): [(expiry, tradingsymbol), ...]} for NIFTY, sorted by expiry.
+    Also records each contract's instrument_token in INST_TOKENS for the ticker.
     """
-    opt = nfo_df[(nfo_df["strike"] == atm) & (nfo_df["instrument_type"].isin(["CE", "PE"]))]
-    if opt.empty:
+    idx = {}
+    for i in instruments:
+        if i.get("name") != "NIFTY" or i.get("instrument_type") not in ("CE", "PE"):
+            continue
+        expiry = _expiry_date(i)
+        if expiry is None:
+            continue
+        idx.setdefault((int(i["strike"]), i["instrument_type"]), []).append((expiry, i["tradingsymbol"]))
+        INST_TOKENS["NFO:" + i["tradingsymbol"]] = i["instrument_token"]
+    for bucket in idx.values():
+        bucket.sort()
+    return idx
+
+def _nearest_symbol(bucket, today):
+    if not bucket:
+        return None
+    j = bisect_left(bucket, (today,))
+    return bucket[j][1] if j < len(bucket) else None
+
+def pick_atm_symbols(opt_index: dict, atm: int, today: date):
+    """
+    Picks nearest (not yet expired) expiry CE/PE for a given strike.
+    """
+    ce = _nearest_symbol(opt_index.get((atm, "CE")), today)
+    pe = _nearest_symbol(opt_index.get((atm, "PE")), today)
+    if not ce or not pe:
         return None, None
-
-    expiry = min(pd.to_datetime(opt["expiry"]).dt.date)
-
-    ce = opt[(opt["instrument_type"] == "CE") & (pd.to_datetime(opt["expiry"]).dt.date == expiry)].iloc[0]["tradingsymbol"]
-    pe = opt[(opt["instrument_type"] == "PE") & (pd.to_datetime(opt["expiry"]).dt.date == expiry)].iloc[0]["tradingsymbol"]
     return ce, pe
 
+def neighbour_symbols(opt_index: dict, atm: int, today: date):
+    """
+    CE/PE tradingsymbols one strike either side of atm: what the next roll can buy.
+    """
+    out = []
+    for strike in (atm - STRIKE_STEP, atm + STRIKE_STEP):
+        out.extend(pick_atm_symbols(opt_index, strike, today))
+    return out
+
 # =========================================================
 # MAIN
 # =========================================================
 
+def next_market_open(now: datetime) -> datetime:
+    """
+    Next MARKET_OPEN on a weekday (today's if still ahead). Exchange holidays
+    are not known here; on one the bot just sits through a quiet session.
+    """
+    d = now.date()
+    if now.time() >= MARKET_OPEN:
+        d += timedelta(days=1)
+    while d.weekday() >= 5:
+        d += timedelta(days=1)
+    return datetime.combine(d, MARKET_OPEN, tzinfo=MARKET_TZ)
+
+def backoff_sleep(prev_delay: float, base: float) -> float:
+    """
+    Sleeps after a failed tick: base on the first failure, doubling per
+    consecutive one up to MAX_RETRY_SEC, plus up to 10% jitter. Returns the
+    un-jittered delay for the next round to double.
+    """
+    delay = min(max(base, prev_delay * 2), MAX_RETRY_SEC)
+    time.sleep(delay * (1 + 0.1 * random.random()))
+    return delay
+
 def main():
-    conn = db_conn()
-    ensure_schema(conn)
+    ensure_schema()
 
-    nfo = pd.DataFrame(kite.instruments("NFO"))
-    nfo = nfo[nfo["name"] == "NIFTY"].copy()
+    opt_index = build_option_index(kite.instruments("NFO"))
+    start_ticker()
 
     # Position state
     pos = {}                 # {"CE": entry_price, "PE": entry_price}
-    ce_ts = pe_ts = None
+    ce_ts = pe_ts = None     # bare tradingsymbols (Stocko orders, DB)
+    ce_key = pe_key = None   # "NFO:<tradingsymbol>" (Kite LTP), built once per leg
     active_atm = None
+    today = datetime.now(MARKET_TZ).date()   # expiry lookups; moved on by the session guard
 
-    last_snap = 0
+    next_tick = time.monotonic()  # POLL_SEC grid the loop wakes on (no drift from work time)
+    next_minute_mono = None  # SNAPSHOT + flag read happen once per wall-clock minute
+    allowed = False
     halted = False
+    last_snap_key = None     # content of the last SNAPSHOT row written
+    last_snap_mono = None
+    err_delay = 0.0          # backoff after a failed tick; doubles per consecutive failure
 
     print(f"🚀 STARTED | LIVE_MODE={LIVE_MODE}")
 
     while True:
+        # sleep to the next grid tick, or the minute edge if that comes first.
+        # interval gating runs on the monotonic clock; `now` is only for the
+        # wall-clock session windows (open / entry / square-off) and log dates
+        # (a minute edge already behind us, e.g. passed on a tick with no spot, is
+        # picked up on the next grid tick; it must not turn the sleep into a spin)
+        mono = time.monotonic()
+        wake = next_tick
+        if next_minute_mono is not None and mono < next_minute_mono < wake:
+            wake = next_minute_mono
+        time.sleep(max(0.0, wake - mono))
+        tick_start = time.monotonic()
+        if tick_start >= next_tick:
+            # fell behind (slow orders / DB)? skip the missed ticks instead of bursting
+            next_tick = max(next_tick + POLL_SEC, tick_start)
         now = datetime.now(MARKET_TZ)
-
-        # session guard
-        if now.time() < MARKET_OPEN or now.time() > MARKET_CLOSE:
-            time.sleep(30)
-            continue
-
-        spot = ltp([SPOT_INSTRUMENT]).get(SPOT_INSTRUMENT)
-        if not spot:
-            time.sleep(POLL_SEC)
-            continue
-
-        atm = int(round(spot / STRIKE_STEP) * STRIKE_STEP)
-
-        # ---------- SNAPSHOT + FLAG ENFORCEMENT ----------
-        if time.time() - last_snap >= SNAPSHOT_SEC:
-            allowed = trade_allowed(conn)
-
+        now_t = now.time()       # derived once; every window check this tick sees the same instant
+        prev_delay, err_delay = err_delay, 0.0   # any tick that gets through resets the backoff
+        try:
+            # session guard
+            if now_t < MARKET_OPEN or now_t > MARKET_CLOSE or now.weekday() >= 5:
+                # one sleep to the next open instead of polling all night / weekend
+                open_at = next_market_open(now)
+                today = open_at.date()   # the session we wake into
+                print(f"💤 MARKET CLOSED, sleeping until {open_at:%a %d-%b %H:%M}")
+                time.sleep(max(0.0, (open_at - now).total_seconds()))
+                continue
+
+            # one LTP round trip per tick: spot + open legs (reused by snapshot / exits / roll)
+            insts = [SPOT_INSTRUMENT] + [k for k in (ce_key, pe_key) if k]
+            quotes = ltp(insts)
+            ce_ltp = quotes.get(ce_key) if ce_key else None
+            pe_ltp = quotes.get(pe_key) if pe_key else None
+
+            spot = quotes.get(SPOT_INSTRUMENT)
+            if not spot:
+                continue
+
+            atm = round_to_strike(spot)
+
+            # open-leg PnL at this tick's prices; shared by SNAPSHOT and every exit row
+            # (a one-sided fill can leave a single leg in pos). 0.0 when flat, None
+            # (NULL in the log) when a held leg has no price: never a made-up PnL
+            leg_ltp = {"CE": ce_ltp, "PE": pe_ltp}
             unreal = 0.0
-            if pos and ce_ts and pe_ts:
-                l = ltp([f"NFO:{ce_ts}", f"NFO:{pe_ts}"])
-                unreal = (
-                    (l[f"NFO:{ce_ts}"] - pos["CE"]) +
-                    (l[f"NFO:{pe_ts}"] - pos["PE"])
-                ) * QTY
-
-            log_db(
-                conn,
-                bot=BOT_NAME,
-                event="SNAPSHOT",
-                reason=f"FLAG={allowed},HALT={halted}",
-                spot=spot,
-                atm=active_atm if active_atm is not None else atm,
-                ce_sym=ce_ts,
-                pe_sym=pe_ts,
-                unreal=unreal,
-                ce_entry=pos.get("CE"),
-                pe_entry=pos.get("PE"),
-                ce_exit=None,
-                pe_exit=None,
-            )
-
-            # Kill-switch enforcement: if FALSE and position exists -> square off now + log exit prices
-            if (not allowed) and pos and ce_ts and pe_ts:
-                ce_exit = pe_exit = None
-                try:
-                    prices = ltp([f"NFO:{ce_ts}", f"NFO:{pe_ts}"])
-                    ce_exit = prices.get(f"NFO:{ce_ts}")
-                    pe_exit = prices.get(f"NFO:{pe_ts}")
-                except Exception:
-                    pass
+            if pos:
+                unreal = None
+                if all(leg_ltp[leg] is not None for leg in pos):
+                    unreal = sum(leg_ltp[leg] - entry for leg, entry in pos.items()) * QTY
 
+            # ---------- SNAPSHOT + FLAG ENFORCEMENT (minute edge) ----------
+            if next_minute_mono is None or tick_start >= next_minute_mono:
                 try:
-                    stocko_place_by_tradingsymbol(ce_ts, "SELL", QTY, 901)
-                    stocko_place_by_tradingsymbol(pe_ts, "SELL", QTY, 902)
-                    print("🛑 FLAG FALSE -> SQUARED OFF")
-                except Exception as e:
-                    print("❌ FLAG EXIT FAILED:", e)
-
-                log_db(
-                    conn,
-                    bot=BOT_NAME,
-                    event="EXIT",
-                    reason="FLAG_FALSE_SQUAREOFF",
-                    spot=spot,
-                    atm=active_atm,
-                    ce_sym=ce_ts,
-                    pe_sym=pe_ts,
-                    unreal=unreal,
-                    ce_entry=pos.get("CE"),
-                    pe_entry=pos.get("PE"),
-                    ce_exit=ce_exit,
-                    pe_exit=pe_exit,
-                )
-
-                pos.clear()
-                ce_ts = pe_ts = None
-                active_atm = None
-                halted = True
-
-            # resume when flag becomes true again
-            if allowed and halted and not pos:
-                halted = False
-                log_db(
-                    conn,
-                    bot=BOT_NAME,
-                    event="RESUME",
-                    reason="FLAG_TRUE_RESUME",
-                    spot=spot,
-                    atm=atm,
-                    ce_sym=None,
-                    pe_sym=None,
-                    unreal=0.0,
-                    ce_entry=None,
-                    pe_entry=None,
-                    ce_exit=None,
-                    pe_exit=None,
-                )
-
-            last_snap = time.time()
-
-        # ---------- TIME EXIT ----------
-        if now.time() >= SQUARE_OFF and pos and ce_ts and pe_ts:
-            ce_exit = pe_exit = None
-            try:
-                prices = ltp([f"NFO:{ce_ts}", f"NFO:{pe_ts}"])
-                ce_exit = prices.get(f"NFO:{ce_ts}")
-                pe_exit = prices.get(f"NFO:{pe_ts}")
-            except Exception:
-                pass
-
-            try:
-                stocko_place_by_tradingsymbol(ce_ts, "SELL", QTY, 101)
-                stocko_place_by_tradingsymbol(pe_ts, "SELL", QTY, 102)
-            except Exception as e:
-                print("❌ 15:25 EXIT FAILED:", e)
-
-            log_db(
-                conn,
-                bot=BOT_NAME,
-                event="EXIT",
-                reason="TIME_SQUAREOFF_1525",
-                spot=spot,
-                atm=active_atm,
-                ce_sym=ce_ts,
-                pe_sym=pe_ts,
-                unreal=None,
-                ce_entry=pos.get("CE"),
-                pe_entry=pos.get("PE"),
-                ce_exit=ce_exit,
-                pe_exit=pe_exit,
-            )
-            print("⏹ 15:25 EXIT")
-            break
-
-        # ---------- HALT ----------
-        if halted:
-            time.sleep(POLL_SEC)
-            continue
+                    allowed = trade_allowed()
+                except psycopg2.Error as e:
+                    # DB down: keep the last flag so the square-off / roll / leg cleanup
+                    # below still run for an open position; retried next minute
+                    print(f"⚠️ FLAG READ FAILED, keeping FLAG={allowed}:", e)
+
+                # skip rows identical to the last one; still write a heartbeat every SNAPSHOT_HEARTBEAT_SEC
+                snap_atm = active_atm if active_atm is not None else atm
+                snap_key = (round(spot, 2), unreal if unreal is None else round(unreal, 2), snap_atm, ce_ts, pe_ts, allowed, halted)
+                if snap_key != last_snap_key or tick_start - last_snap_mono >= SNAPSHOT_HEARTBEAT_SEC:
+                    log_db(
+                        bot=BOT_NAME,
+                        event="SNAPSHOT",
+                        reason=f"FLAG={allowed},HALT={halted}",
+                        spot=spot,
+                        atm=snap_atm,
+                        ce_sym=ce_ts,
+                        pe_sym=pe_ts,
+                        unreal=unreal,
+                        ce_entry=pos.get("CE"),
+                        pe_entry=pos.get("PE"),
+                        ce_exit=None,
+                        pe_exit=None,
+                    )
+                    last_snap_key, last_snap_mono = snap_key, tick_start
 
-        # ---------- ENTRY (first entry) ----------
-        if (not pos) and (now.time() >= ENTRY_START):
-            allowed_now = trade_allowed(conn)
-            if allowed_now and abs(spot - atm) <= ENTRY_TOL:
-                ce_new, pe_new = pick_atm_symbols(nfo, atm)
-                if not ce_new or not pe_new:
-                    time.sleep(POLL_SEC)
-                    continue
-
-                l = ltp([f"NFO:{ce_new}", f"NFO:{pe_new}"])
-                ce_p, pe_p = l.get(f"NFO:{ce_new}"), l.get(f"NFO:{pe_new}")
-                if ce_p is None or pe_p is None:
-                    time.sleep(POLL_SEC)
-                    continue
+                # Kill-switch enforcement: if FALSE and position exists -> square off now + log exit prices
+                if (not allowed) and pos:
+                    ce_err, pe_err = stocko_place_pair(ce_ts, pe_ts, "SELL", QTY, 901, 902)
+                    failed = ce_err or pe_err
+                    if failed:
+                        print("❌ FLAG EXIT FAILED:", failed)
+                    else:
+                        print("🛑 FLAG FALSE -> SQUARED OFF")
 
-                try:
-                    stocko_place_by_tradingsymbol(ce_new, "BUY", QTY, 1)
-                    stocko_place_by_tradingsymbol(pe_new, "BUY", QTY, 2)
-                except Exception as e:
-                    print("❌ ENTRY FAILED:", e)
-                    time.sleep(POLL_SEC)
-                    continue
-
-                # commit state only after success
-                ce_ts, pe_ts = ce_new, pe_new
-                pos["CE"], pos["PE"] = ce_p, pe_p
-                active_atm = atm
+                    log_db(
+                        bot=BOT_NAME,
+                        event="ERROR" if failed else "EXIT",
+                        reason=f"FLAG_FALSE_SQUAREOFF_FAILED err={failed}" if failed else "FLAG_FALSE_SQUAREOFF",
+                        spot=spot,
+                        atm=active_atm,
+                        ce_sym=ce_ts,
+                        pe_sym=pe_ts,
+                        unreal=None if failed else unreal,
+                        ce_entry=pos.get("CE"),
+                        pe_entry=pos.get("PE"),
+                        ce_exit=ce_ltp if ce_ts and ce_err is None else None,
+                        pe_exit=pe_ltp if pe_ts and pe_err is None else None,
+                    )
 
-                log_db(
-                    conn,
-                    bot=BOT_NAME,
-                    event="ENTRY",
-                    reason="FIRST_ENTRY",
-                    spot=spot,
-                    atm=active_atm,
-                    ce_sym=ce_ts,
-                    pe_sym=pe_ts,
-                    unreal=0.0,
-                    ce_entry=pos["CE"],
-                    pe_entry=pos["PE"],
-                    ce_exit=None,
-                    pe_exit=None,
-                )
+                    # drop only the legs that were sold; an unsold leg stays tracked
+                    # so the next attempt sends that leg alone
+                    if ce_err is None:
+                        pos.pop("CE", None)
+                        ce_ts = ce_key = None
+                    if pe_err is None:
+                        pos.pop("PE", None)
+                        pe_ts = pe_key = None
+                    if not pos:
+                        active_atm = None
+                    halted = True
+
+                # resume when flag becomes true again
+                if allowed and halted and not pos:
+                    halted = False
+                    log_db(
+                        bot=BOT_NAME,
+                        event="RESUME",
+                        reason="FLAG_TRUE_RESUME",
+                        spot=spot,
+                        atm=atm,
+                        ce_sym=None,
+                        pe_sym=None,
+                        unreal=0.0,
+                        ce_entry=None,
+                        pe_entry=None,
+                        ce_exit=None,
+                        pe_exit=None,
+                    )
 
-                print(f"✅ ENTRY @ ATM={active_atm} | {ce_ts} & {pe_ts}")
-
-        # ---------- ROLLING LOGIC ----------
-        # Roll only when:
-        #   - position exists
-        #   - ATM has changed (next 50pt zone)
-        #   - spot is within ±ENTRY_TOL of new ATM (prevents flip-flop / noisy rolls)
-        if pos and ce_ts and pe_ts and (active_atm is not None):
-            if atm != active_atm and abs(spot - atm) <= ENTRY_TOL:
-                # capture exit prices first
-                ce_exit = pe_exit = None
-                try:
-                    prices = ltp([f"NFO:{ce_ts}", f"NFO:{pe_ts}"])
-                    ce_exit = prices.get(f"NFO:{ce_ts}")
-                    pe_exit = prices.get(f"NFO:{pe_ts}")
-                except Exception:
-                    pass
+                next_minute_mono = tick_start + 60 - now.second - now.microsecond / 1e6
 
-                # square-off old legs
-                try:
-                    stocko_place_by_tradingsymbol(ce_ts, "SELL", QTY, 201)
-                    stocko_place_by_tradingsymbol(pe_ts, "SELL", QTY, 202)
-                except Exception as e:
-                    print("❌ ROLL EXIT FAILED:", e)
-                    # If exit fails, do not proceed to new entry (safer)
-                    time.sleep(POLL_SEC)
-                    continue
+            # ---------- TIME EXIT ----------
+            if now_t >= SQUARE_OFF and pos:
+                ce_err, pe_err = stocko_place_pair(ce_ts, pe_ts, "SELL", QTY, 101, 102)
+                failed = ce_err or pe_err
+                if failed:
+                    # the bot stops below; the unsold leg is named in the row for manual square-off
+                    print("❌ 15:25 EXIT FAILED:", failed)
 
                 log_db(
-                    conn,
                     bot=BOT_NAME,
-                    event="ROLL_EXIT",
-                    reason=f"ATM_SHIFT {active_atm} -> {atm}",
+                    event="ERROR" if failed else "EXIT",
+                    reason=f"TIME_SQUAREOFF_1525_FAILED err={failed}" if failed else "TIME_SQUAREOFF_1525",
                     spot=spot,
                     atm=active_atm,
                     ce_sym=ce_ts,
                     pe_sym=pe_ts,
-                    unreal=None,
+                    unreal=None if failed else unreal,
                     ce_entry=pos.get("CE"),
                     pe_entry=pos.get("PE"),
-                    ce_exit=ce_exit,
-                    pe_exit=pe_exit,
+                    ce_exit=ce_ltp if ce_ts and ce_err is None else None,
+                    pe_exit=pe_ltp if pe_ts and pe_err is None else None,
                 )
+                print("⏹ 15:25 EXIT")
+                break
+
+            # ---------- HALT ----------
+            if halted:
+                continue
+
+            # flat -> only the entry check runs; in a position -> only the roll check
+            # ---------- ENTRY (first entry) ----------
+            if not pos:
+                if now_t >= ENTRY_START and allowed and abs(spot - atm) <= ENTRY_TOL:
+                    ce_new, pe_new = pick_atm_symbols(opt_index, atm, today)
+                    if not ce_new or not pe_new:
+                        continue
+
+                    ce_new_key, pe_new_key = f"NFO:{ce_new}", f"NFO:{pe_new}"
+                    l = ltp([ce_new_key, pe_new_key])
+                    ce_p, pe_p = l.get(ce_new_key), l.get(pe_new_key)
+                    if ce_p is None or pe_p is None:
+                        continue
+
+                    ce_err, pe_err = stocko_place_pair(ce_new, pe_new, "BUY", QTY, 1, 2)
+                    if ce_err and pe_err:
+                        print("❌ ENTRY FAILED:", ce_err, pe_err)
+                        continue
+
+                    # commit state for every leg that was bought
+                    if ce_err is None:
+                        ce_ts, ce_key, pos["CE"] = ce_new, ce_new_key, ce_p
+                    if pe_err is None:
+                        pe_ts, pe_key, pos["PE"] = pe_new, pe_new_key, pe_p
+                    active_atm = atm
+
+                    if ce_err or pe_err:
+                        # one leg bought: keep it tracked (flag / 15:25 exits close it) and halt
+                        print("❌ ENTRY ONE-SIDED:", ce_err or pe_err)
+                        log_db(
+                            bot=BOT_NAME,
+                            event="ERROR",
+                            reason=f"ENTRY_PARTIAL atm={atm} err={ce_err or pe_err}",
+                            spot=spot,
+                            atm=active_atm,
+                            ce_sym=ce_ts,
+                            pe_sym=pe_ts,
+                            unreal=0.0,
+                            ce_entry=pos.get("CE"),
+                            pe_entry=pos.get("PE"),
+                            ce_exit=None,
+                            pe_exit=None,
+                        )
+                        halted = True
+                        continue
 
-                # pick new ATM symbols
-                ce_new, pe_new = pick_atm_symbols(nfo, atm)
-                if not ce_new or not pe_new:
-                    # exited but cannot re-enter; clear state safely
-                    pos.clear()
-                    ce_ts = pe_ts = None
-                    active_atm = None
                     log_db(
-                        conn,
                         bot=BOT_NAME,
-                        event="ERROR",
-                        reason=f"ROLL_REENTRY_SYMBOL_NOT_FOUND atm={atm}",
+                        event="ENTRY",
+                        reason="FIRST_ENTRY",
                         spot=spot,
-                        atm=atm,
-                        ce_sym=None,
-                        pe_sym=None,
-                        unreal=None,
-                        ce_entry=None,
-                        pe_entry=None,
+                        atm=active_atm,
+                        ce_sym=ce_ts,
+                        pe_sym=pe_ts,
+                        unreal=0.0,
+                        ce_entry=pos["CE"],
+                        pe_entry=pos["PE"],
                         ce_exit=None,
                         pe_exit=None,
                     )
-                    time.sleep(POLL_SEC)
-                    continue
 
-                l2 = ltp([f"NFO:{ce_new}", f"NFO:{pe_new}"])
-                ce_p2, pe_p2 = l2.get(f"NFO:{ce_new}"), l2.get(f"NFO:{pe_new}")
-                if ce_p2 is None or pe_p2 is None:
+                    print(f"✅ ENTRY @ ATM={active_atm} | {ce_ts} & {pe_ts}")
+                    stocko_prewarm_tokens(neighbour_symbols(opt_index, active_atm, today))
+
+            # ---------- ROLLING LOGIC ----------
+            # Roll only when:
+            #   - position exists
+            #   - ATM has changed (next 50pt zone)
+            #   - spot is within ±ENTRY_TOL of new ATM (prevents flip-flop / noisy rolls)
+            elif ce_ts and pe_ts and (active_atm is not None):
+                if atm != active_atm and abs(spot - atm) <= ENTRY_TOL:
+                    # capture exit prices first
+                    ce_exit, pe_exit = ce_ltp, pe_ltp
+
+                    # square-off old legs
+                    ce_err, pe_err = stocko_place_pair(ce_ts, pe_ts, "SELL", QTY, 201, 202)
+                    if ce_err and pe_err:
+                        print("❌ ROLL EXIT FAILED:", ce_err, pe_err)
+                        # nothing sold: keep the position, a later tick may roll again
+                        continue
+                    if ce_err or pe_err:
+                        # one leg sold, the other still held: never resend the pair
+                        # (that would sell the sold leg again); track what is left and halt
+                        print("❌ ROLL EXIT ONE-SIDED:", ce_err or pe_err)
+                        log_db(
+                            bot=BOT_NAME,
+                            event="ERROR",
+                            reason=f"ROLL_EXIT_PARTIAL {active_atm} -> {atm} err={ce_err or pe_err}",
+                            spot=spot,
+                            atm=active_atm,
+                            ce_sym=ce_ts,
+                            pe_sym=pe_ts,
+                            unreal=None,
+                            ce_entry=pos.get("CE"),
+                            pe_entry=pos.get("PE"),
+                            ce_exit=None if ce_err else ce_exit,
+                            pe_exit=None if pe_err else pe_exit,
+                        )
+                        if ce_err is None:
+                            del pos["CE"]
+                            ce_ts = ce_key = None
+                        else:
+                            del pos["PE"]
+                            pe_ts = pe_key = None
+                        halted = True
+                        continue
+
+                    # both old legs are sold: go flat before anything else runs, so neither
+                    # a failed re-entry nor an exception reaching the loop's handler leaves
+                    # the sold legs in pos for the next tick to sell again
+                    old_atm, old_ce, old_pe, old_pos = active_atm, ce_ts, pe_ts, dict(pos)
                     pos.clear()
-                    ce_ts = pe_ts = None
+                    ce_ts = pe_ts = ce_key = pe_key = None
                     active_atm = None
+
                     log_db(
-                        conn,
                         bot=BOT_NAME,
-                        event="ERROR",
-                        reason=f"ROLL_REENTRY_LTP_MISSING atm={atm}",
+                        event="ROLL_EXIT",
+                        reason=f"ATM_SHIFT {old_atm} -> {atm}",
                         spot=spot,
-                        atm=atm,
-                        ce_sym=ce_new,
-                        pe_sym=pe_new,
-                        unreal=None,
-                        ce_entry=None,
-                        pe_entry=None,
-                        ce_exit=None,
-                        pe_exit=None,
+                        atm=old_atm,
+                        ce_sym=old_ce,
+                        pe_sym=old_pe,
+                        unreal=unreal,
+                        ce_entry=old_pos.get("CE"),
+                        pe_entry=old_pos.get("PE"),
+                        ce_exit=ce_exit,
+                        pe_exit=pe_exit,
                     )
-                    time.sleep(POLL_SEC)
-                    continue
 
-                # enter new legs
-                try:
-                    stocko_place_by_tradingsymbol(ce_new, "BUY", QTY, 203)
-                    stocko_place_by_tradingsymbol(pe_new, "BUY", QTY, 204)
-                except Exception as e:
-                    print("❌ ROLL ENTRY FAILED:", e)
-                    # exited already; clear state to avoid phantom position
-                    pos.clear()
-                    ce_ts = pe_ts = None
-                    active_atm = None
+                    # pick new ATM symbols
+                    ce_new, pe_new = pick_atm_symbols(opt_index, atm, today)
+                    if not ce_new or not pe_new:
+                        # exited but cannot re-enter; stay flat
+                        log_db(
+                            bot=BOT_NAME,
+                            event="ERROR",
+                            reason=f"ROLL_REENTRY_SYMBOL_NOT_FOUND atm={atm}",
+                            spot=spot,
+                            atm=atm,
+                            ce_sym=None,
+                            pe_sym=None,
+                            unreal=None,
+                            ce_entry=None,
+                            pe_entry=None,
+                            ce_exit=None,
+                            pe_exit=None,
+                        )
+                        continue
+
+                    ce_new_key, pe_new_key = f"NFO:{ce_new}", f"NFO:{pe_new}"
+                    try:
+                        l2 = ltp([ce_new_key, pe_new_key])
+                    except Exception as e:
+                        # log it as a failed re-entry rather than leave it to the loop's backoff
+                        print("⚠️ ROLL LTP FAILED:", e)
+                        l2 = {}
+                    ce_p2, pe_p2 = l2.get(ce_new_key), l2.get(pe_new_key)
+                    if ce_p2 is None or pe_p2 is None:
+                        log_db(
+                            bot=BOT_NAME,
+                            event="ERROR",
+                            reason=f"ROLL_REENTRY_LTP_MISSING atm={atm}",
+                            spot=spot,
+                            atm=atm,
+                            ce_sym=ce_new,
+                            pe_sym=pe_new,
+                            unreal=None,
+                            ce_entry=None,
+                            pe_entry=None,
+                            ce_exit=None,
+                            pe_exit=None,
+                        )
+                        continue
+
+                    # enter new legs (state is flat since the exit)
+                    ce_err, pe_err = stocko_place_pair(ce_new, pe_new, "BUY", QTY, 203, 204)
+                    if ce_err and pe_err:
+                        print("❌ ROLL ENTRY FAILED:", ce_err, pe_err)
+                        log_db(
+                            bot=BOT_NAME,
+                            event="ERROR",
+                            reason=f"ROLL_ENTRY_FAILED atm={atm} err={ce_err}",
+                            spot=spot,
+                            atm=atm,
+                            ce_sym=ce_new,
+                            pe_sym=pe_new,
+                            unreal=None,
+                            ce_entry=None,
+                            pe_entry=None,
+                            ce_exit=None,
+                            pe_exit=None,
+                        )
+                        continue
+
+                    # commit state for every leg that was bought
+                    if ce_err is None:
+                        ce_ts, ce_key, pos["CE"] = ce_new, ce_new_key, ce_p2
+                    if pe_err is None:
+                        pe_ts, pe_key, pos["PE"] = pe_new, pe_new_key, pe_p2
+                    active_atm = atm
+
+                    if ce_err or pe_err:
+                        # one new leg bought: keep it tracked (flag / 15:25 exits close it) and halt
+                        print("❌ ROLL ENTRY ONE-SIDED:", ce_err or pe_err)
+                        log_db(
+                            bot=BOT_NAME,
+                            event="ERROR",
+                            reason=f"ROLL_ENTRY_PARTIAL atm={atm} err={ce_err or pe_err}",
+                            spot=spot,
+                            atm=active_atm,
+                            ce_sym=ce_ts,
+                            pe_sym=pe_ts,
+                            unreal=0.0,
+                            ce_entry=pos.get("CE"),
+                            pe_entry=pos.get("PE"),
+                            ce_exit=None,
+                            pe_exit=None,
+                        )
+                        halted = True
+                        continue
+
                     log_db(
-                        conn,
                         bot=BOT_NAME,
-                        event="ERROR",
-                        reason=f"ROLL_ENTRY_FAILED atm={atm} err={e}",
+                        event="ROLL_ENTRY",
+                        reason=f"ROLLED_TO_ATM={active_atm}",
                         spot=spot,
-                        atm=atm,
-                        ce_sym=ce_new,
-                        pe_sym=pe_new,
-                        unreal=None,
-                        ce_entry=None,
-                        pe_entry=None,
+                        atm=active_atm,
+                        ce_sym=ce_ts,
+                        pe_sym=pe_ts,
+                        unreal=0.0,
+                        ce_entry=pos["CE"],
+                        pe_entry=pos["PE"],
                         ce_exit=None,
                         pe_exit=None,
                     )
-                    time.sleep(POLL_SEC)
-                    continue
-
-                # commit new position state
-                ce_ts, pe_ts = ce_new, pe_new
-                pos["CE"], pos["PE"] = ce_p2, pe_p2
-                active_atm = atm
-
-                log_db(
-                    conn,
-                    bot=BOT_NAME,
-                    event="ROLL_ENTRY",
-                    reason=f"ROLLED_TO_ATM={active_atm}",
-                    spot=spot,
-                    atm=active_atm,
-                    ce_sym=ce_ts,
-                    pe_sym=pe_ts,
-                    unreal=0.0,
-                    ce_entry=pos["CE"],
-                    pe_entry=pos["PE"],
-                    ce_exit=None,
-                    pe_exit=None,
-                )
-
-                print(f"🔁 ROLLED to ATM={active_atm} | {ce_ts} & {pe_ts}")
 
-        time.sleep(POLL_SEC)
+                    print(f"🔁 ROLLED to ATM={active_atm} | {ce_ts} & {pe_ts}")
+                    stocko_prewarm_tokens(neighbour_symbols(opt_index, active_atm, today))
+        except (requests.exceptions.RequestException, NetworkException) as e:
+            # Kite timeouts, connection resets, Kite 429s
+            print("⚠️ NETWORK:", e)
+            err_delay = backoff_sleep(prev_delay, 0.2)
+        except psycopg2.OperationalError as e:
+            # pooled_conn() already dropped the broken connection; the pool opens a fresh one
+            print("⚠️ DB:", e)
+            err_delay = backoff_sleep(prev_delay, 1.0)
+        except Exception:
+            # a bug, not the network: keep it loud
+            traceback.print_exc()
+            err_delay = backoff_sleep(prev_delay, 2.0)
 
 if __name__ == "__main__":
-    main()
+    # dyno restarts/deploys send SIGTERM; turn it into SystemExit so the
+    # queued log rows are drained below instead of dying with the process
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        main()
+    finally:
+        flush_snapshots()